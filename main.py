@@ -1,16 +1,30 @@
 import argparse
+import hashlib
 import logging
+import os
 import sys
+import uuid
 
 from dotenv import load_dotenv
 
-# from langchain.prompts import ChatPromptTemplate
 from langchain.agents import create_agent
-from langchain.chat_models import init_chat_model
-from langchain.messages import ToolMessage
-from langgraph.checkpoint.memory import InMemorySaver
+from langchain.chat_models import BaseChatModel
+from langchain.messages import AIMessage, ToolMessage
+from langgraph.checkpoint.base import BaseCheckpointSaver
+from langgraph.checkpoint.sqlite import SqliteSaver
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 
-from tools import list_files, read_file
+try:
+    from langchain_anthropic import ChatAnthropic
+    from langchain_anthropic.middleware import AnthropicPromptCachingMiddleware
+except ImportError:
+    ChatAnthropic = None
+    AnthropicPromptCachingMiddleware = None
+
+from middleware import ToolConcurrencyMiddleware, TrimToolResultsMiddleware
+from tools import clear_prefetched, list_files, prefetch_paths, read_file
+
+logger = logging.getLogger(__name__)
 
 # ANSI escape codes for colored output
 COLOR = {
@@ -22,31 +36,230 @@ COLOR = {
     "CYAN": "\033[96m",
     "ENDC": "\033[0m",
 }
+# (prefix, suffix) pairs so color_print can emit everything in one write
+_COLOR_WRAP = {key: (code, COLOR["ENDC"]) for key, code in COLOR.items()}
+
+SYSTEM_PROMPT = """You are a helpful coding assistant.
+
+You have access to two tools:
+
+- read_file: use this to get the contents of a file
+- lkst_files: use this to list all files in a specific directory
+
+If a user asks you for file content, make sure you use the tools."""
+
+# On-disk checkpoint store shared by every run of the agent
+STATE_DB_PATH = ".agent_state.sqlite"
 
 
-def color_print(color_key: str, *args, **kwargs):
+def color_print(
+    color_key: str, *args, sep: str = " ", end: str = "\n", file=None, flush=False
+):
     """Prints text in a specified color."""
-    print(COLOR[color_key], end="")
-    print(*args, **kwargs)
-    print(COLOR["ENDC"], end="")
+    prefix, suffix = _COLOR_WRAP[color_key]
+    out = file or sys.stdout
+    out.write(prefix + sep.join(map(str, args)) + suffix + end)
+    if flush:
+        out.flush()
+
+
+def get_thread_id() -> str:
+    """Returns a conversation id that stays stable across runs."""
+    thread_id = os.getenv("AGENT_THREAD_ID")
+    if thread_id:
+        return thread_id
+    return hashlib.sha256(os.getcwd().encode()).hexdigest()[:16]
+
+
+def get_tool_concurrency_limit() -> int:
+    """Reads the maximum number of parallel tool calls from TOOL_CONCURRENCY_LIMIT."""
+    value = os.getenv("TOOL_CONCURRENCY_LIMIT", "8")
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError(
+            f"TOOL_CONCURRENCY_LIMIT must be an integer, got {value!r}"
+        ) from None
+    if limit < 1:
+        raise ValueError(f"TOOL_CONCURRENCY_LIMIT must be at least 1, got {limit}")
+    return limit
+
+
+def stream_response(agent, inputs: dict, config: dict) -> list:
+    """Streams model token deltas to stdout and returns every message seen.
+
+    Models that do not stream emit whole `AIMessage`s, which are printed as-is.
+    """
+    messages = []
+    for chunk, _metadata in agent.stream(inputs, config=config, stream_mode="messages"):
+        messages.append(chunk)
+        if isinstance(chunk, AIMessage) and chunk.text:
+            sys.stdout.write(chunk.text)
+            sys.stdout.flush()
+    sys.stdout.write("\n")
+    return messages
+
+
+async def astream_response(agent, inputs: dict, config: dict) -> list:
+    """Async counterpart of `stream_response`, driven by `astream_events`."""
+    messages = []
+    streamed_runs = set()
+    async for event in agent.astream_events(inputs, config=config, version="v2"):
+        kind = event["event"]
+        if kind == "on_chat_model_stream":
+            streamed_runs.add(event["run_id"])
+            chunk = event["data"]["chunk"]
+            messages.append(chunk)
+            if chunk.text:
+                sys.stdout.write(chunk.text)
+                sys.stdout.flush()
+        elif kind == "on_chat_model_end" and event["run_id"] not in streamed_runs:
+            # The model did not stream, so its whole reply arrives only here
+            output = event["data"].get("output")
+            if isinstance(output, AIMessage):
+                messages.append(output)
+                if output.text:
+                    sys.stdout.write(output.text)
+                    sys.stdout.flush()
+        elif kind == "on_tool_end":
+            output = event["data"].get("output")
+            if isinstance(output, ToolMessage):
+                messages.append(output)
+    sys.stdout.write("\n")
+    return messages
+
+
+def _batch_inputs(
+    prompts: list[str], config_base: dict | None, max_concurrency: int
+) -> tuple[list[dict], list[dict]]:
+    """Builds per-prompt agent inputs and configs, one fresh thread per prompt."""
+    config_base = config_base or {}
+    # Unique per call so a later batch never resumes an earlier batch's threads
+    batch_id = uuid.uuid4().hex
+    inputs = [{"messages": [{"role": "user", "content": p}]} for p in prompts]
+    configs = [
+        {
+            **config_base,
+            "configurable": {
+                **config_base.get("configurable", {}),
+                "thread_id": f"batch-{batch_id}-{i}",
+            },
+            "max_concurrency": max_concurrency,
+        }
+        for i, _ in enumerate(prompts)
+    ]
+    return inputs, configs
+
+
+def run_batch(
+    prompts: list[str],
+    config_base: dict | None = None,
+    max_concurrency: int = 16,
+    agent=None,
+) -> list[dict]:
+    """Runs independent prompts concurrently and returns results in order.
+
+    Without an `agent`, one is built with `build_agent` on the on-disk
+    checkpointer that `main()` uses.
+    """
+    inputs, configs = _batch_inputs(prompts, config_base, max_concurrency)
+    if agent is not None:
+        return agent.batch(inputs, config=configs)
+    with SqliteSaver.from_conn_string(STATE_DB_PATH) as checkpointer:
+        return build_agent(checkpointer).batch(inputs, config=configs)
+
+
+async def arun_batch(
+    prompts: list[str],
+    config_base: dict | None = None,
+    max_concurrency: int = 16,
+    agent=None,
+):
+    """Runs independent prompts concurrently, yielding `(index, result)` pairs.
+
+    A passed-in `agent` must use an async-capable checkpointer (e.g.
+    `AsyncSqliteSaver`); the sync `SqliteSaver` rejects async calls. Without
+    one, an agent is built on an `AsyncSqliteSaver` over the on-disk store.
+    """
+    inputs, configs = _batch_inputs(prompts, config_base, max_concurrency)
+    if agent is not None:
+        async for i, result in agent.abatch_as_completed(inputs, config=configs):
+            yield i, result
+        return
+    async with AsyncSqliteSaver.from_conn_string(STATE_DB_PATH) as checkpointer:
+        agent = build_agent(checkpointer)
+        async for i, result in agent.abatch_as_completed(inputs, config=configs):
+            yield i, result
+
+
+# Chat model shared by every get_chat_model() call once it has been built
+_chat_model: BaseChatModel | None = None
 
 
-# def get_chat_model() -> BaseChatModel:
-#     """
-#     Initializes and returns a LangChain chat model.
-#     This function localizes the provider-specific import and instantiation.
-#     """
-#     # The provider-specific import is contained within this function.
-#     # from langchain_anthropic import ChatAnthropic
+def get_chat_model() -> BaseChatModel | None:
+    """
+    Initializes and returns a LangChain chat model.
+    A successfully built model is reused by every later call; failures are not
+    cached, so a later call can retry.
+    """
+    global _chat_model
+    if _chat_model is not None:
+        return _chat_model
 
-#     try:
-#         # This is where you could add logic to switch between providers
-#         # (e.g., based on an environment variable).
-#         model = ChatAnthropic(model="claude-3-5-sonnet-20240620")
-#         return model
-#     except Exception as e:
-#         logging.error(f"Failed to initialize the ChatAnthropic model: {e}")
-#         return None
+    if ChatAnthropic is None:
+        logger.error("langchain-anthropic is not installed")
+        return None
+
+    try:
+        # This is where you could add logic to switch between providers
+        # (e.g., based on an environment variable).
+        _chat_model = ChatAnthropic(
+            model="claude-sonnet-4-5-20250929",
+            temperature=0.5,
+            timeout=10,
+            max_tokens=1000,
+        )
+        return _chat_model
+    except Exception as e:
+        logger.error("Failed to initialize the ChatAnthropic model: %s", e)
+        return None
+
+
+def build_agent(
+    checkpointer: BaseCheckpointSaver,
+    model: BaseChatModel | None = None,
+    tool_concurrency_limit: int | None = None,
+):
+    """Builds the coding agent, defaulting to the shared chat model and env limit."""
+    if model is None:
+        model = get_chat_model()
+        if model is None:
+            raise RuntimeError("Could not initialize the chat model.")
+    if tool_concurrency_limit is None:
+        tool_concurrency_limit = get_tool_concurrency_limit()
+
+    # Old tool results are elided first, then the system prompt and the last
+    # tool schema are marked with `cache_control` so Anthropic reuses the
+    # cached prefix on every turn after the first. Elision advances in blocks
+    # of 20 messages, so it only invalidates that prefix once per block.
+    middleware = [
+        # Tool calls from a single AI message run in parallel; this caps how
+        # many run at once without throttling the graph itself.
+        ToolConcurrencyMiddleware(tool_concurrency_limit),
+        TrimToolResultsMiddleware(max_recent_messages=20),
+    ]
+    if AnthropicPromptCachingMiddleware is not None:
+        middleware.append(
+            AnthropicPromptCachingMiddleware(unsupported_model_behavior="ignore")
+        )
+
+    return create_agent(
+        model=model,
+        system_prompt=SYSTEM_PROMPT,
+        tools=[read_file, list_files],
+        middleware=middleware,
+        checkpointer=checkpointer,
+    )
 
 
 def main():
@@ -66,10 +279,7 @@ def main():
         level=log_level, format="%(asctime)s - %(levelname)s - %(message)s"
     )
 
-    # model = get_chat_model()
-    model = init_chat_model(
-        "claude-sonnet-4-5-20250929", temperature=0.5, timeout=10, max_tokens=1000
-    )
+    model = get_chat_model()
     if not model:
         color_print("RED", "Error: Could not initialize the chat model.")
         print(
@@ -82,51 +292,40 @@ def main():
         )
         sys.exit(1)
 
-    # tools = [read_file, list_files, bash, edit_file]
-
-    # prompt = ChatPromptTemplate.from_messages([
-    #     ("system", "You are a helpful assistant."),
-    #     ("placeholder", "{chat_history}"),
-    #     ("human", "{input}"),
-    #     ("placeholder", "{agent_scratchpad}"),
-    # ])
-    SYSTEM_PROMPT = """You are a helpful coding assistant.
-
-    You have access to two tools:
-
-    - read_file: use this to get the contents of a file
-    - lkst_files: use this to list all files in a specific directory
-
-    If a user asks you for file content, make sure you use the tools."""
+    try:
+        tool_concurrency_limit = get_tool_concurrency_limit()
+    except ValueError as e:
+        color_print("RED", f"Error: {e}")
+        sys.exit(1)
 
     # Complete implementation of coding agent using latest Langchain 1.x API
-    checkpointer = InMemorySaver()
+    # Conversation state is persisted to disk so that later runs resume the
+    # same thread with a byte-identical prefix and keep hitting the prompt cache.
+    with SqliteSaver.from_conn_string(STATE_DB_PATH) as checkpointer:
+        agent = build_agent(checkpointer, model, tool_concurrency_limit)
 
-    agent = create_agent(
-        model=model,
-        system_prompt=SYSTEM_PROMPT,
-        tools=[read_file, list_files],
-        # context_schema=Context,
-        # response_format=str,
-        checkpointer=checkpointer,
-    )
-
-    # `thread_id` is a unique identifier for a given conversation.
-    config = {"configurable": {"thread_id": "1"}}
-
-    response = agent.invoke(
-        {"messages": [{"role": "user", "content": "What's in pyproject.toml?"}]},
-        config=config,
-        # context=Context(user_id="1")
-    )
+        # `thread_id` is a unique identifier for a given conversation.
+        config = {"configurable": {"thread_id": get_thread_id()}}
 
-    print(response)
+        prompt = "What's in pyproject.toml?"
+        # Start reading files the prompt mentions while the model is still decoding
+        prefetch_paths(prompt)
+        try:
+            messages = stream_response(
+                agent,
+                {"messages": [{"role": "user", "content": prompt}]},
+                config=config,
+            )
+        finally:
+            clear_prefetched()
 
+    # A resumed thread may answer from history without calling a tool.
     first_ai_content = next(
-        msg.content for msg in response["messages"] if isinstance(msg, ToolMessage)
+        (msg.content for msg in messages if isinstance(msg, ToolMessage)), None
     )
 
-    print(first_ai_content)
+    if first_ai_content is not None:
+        print(first_ai_content)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,134 @@
+"""Agent middleware for the codegen demo agent."""
+
+import asyncio
+import hashlib
+import logging
+import threading
+from collections.abc import Awaitable, Callable
+
+from langchain.agents.middleware import (
+    AgentMiddleware,
+    ModelRequest,
+    ModelResponse,
+    ToolCallRequest,
+)
+from langchain.messages import AnyMessage, ToolMessage
+from langgraph.types import Command
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on remembered placeholders per TrimToolResultsMiddleware
+MAX_CACHED_PLACEHOLDERS = 1024
+
+
+class TrimToolResultsMiddleware(AgentMiddleware):
+    """Elides old tool results from the messages sent to the model.
+
+    `ToolMessage` contents older than the last `max_recent_messages` messages
+    are replaced with a short size/hash placeholder. The cutoff only advances
+    in steps of `block_size` messages and a placeholder depends only on the
+    message content, so the prefix sent to the model stays byte-identical
+    between steps. This keeps `AnthropicPromptCachingMiddleware` hitting its
+    cache: the cached prefix is invalidated once per block, not on every turn.
+
+    The checkpointed history is left untouched, so the full contents can
+    always be recovered from the agent state.
+    """
+
+    def __init__(self, max_recent_messages: int = 20, block_size: int | None = None):
+        super().__init__()
+        self.max_recent_messages = max_recent_messages
+        self.block_size = block_size or max_recent_messages
+        # Placeholders of already elided messages, keyed by tool call id, so old
+        # results are not re-hashed on every model call
+        self._placeholders: dict[str, str] = {}
+
+    def _cutoff(self, message_count: int) -> int:
+        overflow = message_count - self.max_recent_messages
+        if overflow <= 0:
+            return 0
+        return overflow // self.block_size * self.block_size
+
+    def _placeholder(self, msg: ToolMessage) -> str:
+        placeholder = self._placeholders.get(msg.tool_call_id)
+        if placeholder is None:
+            raw = msg.content.encode()
+            digest = hashlib.sha256(raw).hexdigest()[:8]
+            placeholder = f"[elided {len(raw)}B tool result sha256={digest}]"
+            self._placeholders[msg.tool_call_id] = placeholder
+            if len(self._placeholders) > MAX_CACHED_PLACEHOLDERS:
+                # Evicting is safe: a placeholder is recomputed identically
+                del self._placeholders[next(iter(self._placeholders))]
+        return placeholder
+
+    def _trim(self, messages: list[AnyMessage]) -> list[AnyMessage]:
+        cutoff = self._cutoff(len(messages))
+        trimmed = list(messages)
+        for i in range(cutoff):
+            msg = messages[i]
+            if isinstance(msg, ToolMessage) and isinstance(msg.content, str):
+                placeholder = self._placeholder(msg)
+                trimmed[i] = msg.model_copy(update={"content": placeholder})
+        return trimmed
+
+    def _trim_request(self, request: ModelRequest) -> ModelRequest:
+        if self._cutoff(len(request.messages)) == 0:
+            return request
+        logger.info(
+            "Eliding tool results before the last %s messages",
+            self.max_recent_messages,
+        )
+        return request.override(messages=self._trim(request.messages))
+
+    def wrap_model_call(
+        self,
+        request: ModelRequest,
+        handler: Callable[[ModelRequest], ModelResponse],
+    ) -> ModelResponse:
+        return handler(self._trim_request(request))
+
+    async def awrap_model_call(
+        self,
+        request: ModelRequest,
+        handler: Callable[[ModelRequest], Awaitable[ModelResponse]],
+    ) -> ModelResponse:
+        return await handler(self._trim_request(request))
+
+
+class ToolConcurrencyMiddleware(AgentMiddleware):
+    """Caps how many tool calls run at the same time.
+
+    The agent already dispatches the tool calls of one AI message in
+    parallel; this bounds that fan-out at the tool layer, so the graph's own
+    executor (and the streaming consumer) is never starved.
+    """
+
+    def __init__(self, limit: int):
+        super().__init__()
+        if limit < 1:
+            raise ValueError(f"Tool concurrency limit must be at least 1, got {limit}")
+        self.limit = limit
+        self._slots = threading.BoundedSemaphore(limit)
+
+    def wrap_tool_call(
+        self,
+        request: ToolCallRequest,
+        handler: Callable[[ToolCallRequest], ToolMessage | Command],
+    ) -> ToolMessage | Command:
+        with self._slots:
+            return handler(request)
+
+    async def awrap_tool_call(
+        self,
+        request: ToolCallRequest,
+        handler: Callable[[ToolCallRequest], Awaitable[ToolMessage | Command]],
+    ) -> ToolMessage | Command:
+        # Wait for a slot off the event loop so other tasks keep running
+        await asyncio.to_thread(self._slots.acquire)
+        try:
+            return await handler(request)
+        finally:
+            self._slots.release()
+
+
+__all__ = ["ToolConcurrencyMiddleware", "TrimToolResultsMiddleware"]
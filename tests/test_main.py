@@ -0,0 +1,170 @@
+import asyncio
+import itertools
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from langchain.agents import create_agent
+from langchain.messages import AIMessage, ToolMessage
+from langchain.tools import tool
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langgraph.checkpoint.memory import InMemorySaver
+
+import main
+from main import arun_batch, astream_response, run_batch, stream_response
+from middleware import ToolConcurrencyMiddleware
+
+
+class FakeToolModel(GenericFakeChatModel):
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+
+@tool
+def slow_tool(n: int) -> str:
+    """Sleeps briefly and echoes its argument."""
+    time.sleep(0.3)
+    return str(n)
+
+
+def tool_calls(count):
+    return AIMessage(
+        "",
+        tool_calls=[
+            {"name": "slow_tool", "args": {"n": i}, "id": f"call-{i}"}
+            for i in range(count)
+        ],
+    )
+
+
+@pytest.fixture
+def fake_agent_env(tmp_path, monkeypatch):
+    """Points the batch helpers at a fake model and a throwaway state store."""
+    model = FakeToolModel(messages=itertools.cycle([AIMessage("answer")]))
+    monkeypatch.setattr(main, "_chat_model", model)
+    monkeypatch.setattr(main, "STATE_DB_PATH", str(tmp_path / "state.sqlite"))
+    return model
+
+
+def test_run_batch_runs_each_prompt_in_a_fresh_thread(fake_agent_env):
+    first = run_batch(["a", "b"], {"tags": ["eval"]}, max_concurrency=4)
+    second = run_batch(["a", "b"])
+
+    for results in (first, second):
+        assert [[m.content for m in r["messages"]] for r in results] == [
+            ["a", "answer"],
+            ["b", "answer"],
+        ]
+
+
+def test_run_batch_uses_a_passed_agent(fake_agent_env):
+    agent = main.build_agent(InMemorySaver())
+
+    results = run_batch(["a"], agent=agent)
+
+    assert [m.content for m in results[0]["messages"]] == ["a", "answer"]
+
+
+def test_arun_batch_yields_every_result_once(fake_agent_env):
+    async def collect():
+        return [item async for item in arun_batch(["a", "b", "c"])]
+
+    results = dict(asyncio.run(collect()))
+
+    assert sorted(results) == [0, 1, 2]
+    assert [results[i]["messages"][0].content for i in range(3)] == ["a", "b", "c"]
+    assert all(len(r["messages"]) == 2 for r in results.values())
+
+
+def test_get_chat_model_does_not_cache_failures(monkeypatch):
+    built = object()
+    attempts = []
+
+    def chat_anthropic(**kwargs):
+        attempts.append(kwargs)
+        if len(attempts) == 1:
+            raise RuntimeError("missing API key")
+        return built
+
+    monkeypatch.setattr(main, "_chat_model", None)
+    monkeypatch.setattr(main, "ChatAnthropic", chat_anthropic)
+
+    assert main.get_chat_model() is None
+    assert main.get_chat_model() is built
+    assert main.get_chat_model() is built
+    assert len(attempts) == 2
+
+
+@pytest.mark.parametrize(
+    "limit, min_seconds, max_seconds", [(1, 1.2, 1.8), (2, 0.6, 0.9), (4, 0.3, 0.6)]
+)
+def test_stream_response_runs_tools_within_concurrency_limit(
+    limit, min_seconds, max_seconds
+):
+    model = FakeToolModel(
+        messages=iter([tool_calls(4), AIMessage("done")]), disable_streaming=True
+    )
+    agent = create_agent(
+        model, tools=[slow_tool], middleware=[ToolConcurrencyMiddleware(limit)]
+    )
+
+    start = time.monotonic()
+    messages = stream_response(
+        agent, {"messages": [{"role": "user", "content": "go"}]}, config={}
+    )
+    elapsed = time.monotonic() - start
+
+    assert min_seconds <= elapsed < max_seconds
+    assert sum(type(m).__name__ == "ToolMessage" for m in messages) == 4
+
+
+@pytest.mark.parametrize("value", ["0", "-2", "many"])
+def test_get_tool_concurrency_limit_rejects_invalid_values(value, monkeypatch):
+    monkeypatch.setenv("TOOL_CONCURRENCY_LIMIT", value)
+
+    with pytest.raises(ValueError, match="TOOL_CONCURRENCY_LIMIT"):
+        main.get_tool_concurrency_limit()
+
+
+def reply_agent(streaming: bool):
+    if streaming:
+        # The fake model cannot stream tool calls, so the streamed turn is text only
+        replies = [AIMessage("the answer")]
+    else:
+        replies = [tool_calls(2), AIMessage("the answer")]
+    model = FakeToolModel(messages=iter(replies), disable_streaming=not streaming)
+    return create_agent(model, tools=[slow_tool])
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+def test_stream_response_prints_reply_and_returns_tool_messages(streaming, capsys):
+    agent = reply_agent(streaming)
+
+    messages = stream_response(
+        agent, {"messages": [{"role": "user", "content": "go"}]}, config={}
+    )
+
+    assert capsys.readouterr().out == "the answer\n"
+    tool_messages = [m for m in messages if isinstance(m, ToolMessage)]
+    assert [m.content for m in tool_messages] == ([] if streaming else ["0", "1"])
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+def test_astream_response_prints_reply_and_returns_tool_messages(streaming, capsys):
+    agent = reply_agent(streaming)
+
+    messages = asyncio.run(
+        astream_response(
+            agent, {"messages": [{"role": "user", "content": "go"}]}, config={}
+        )
+    )
+
+    assert capsys.readouterr().out == "the answer\n"
+    tool_messages = [m for m in messages if isinstance(m, ToolMessage)]
+    assert sorted(m.content for m in tool_messages) == (
+        [] if streaming else ["0", "1"]
+    )
@@ -0,0 +1,43 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from langchain.messages import AIMessage, HumanMessage, ToolMessage
+
+from middleware import TrimToolResultsMiddleware
+
+
+def test_trim_elides_only_tool_results_outside_recent_window():
+    middleware = TrimToolResultsMiddleware(max_recent_messages=2)
+    messages = [
+        HumanMessage("read it"),
+        ToolMessage("old contents", tool_call_id="1"),
+        AIMessage("done"),
+        ToolMessage("new contents", tool_call_id="2"),
+    ]
+
+    trimmed = middleware._trim(messages)
+
+    assert trimmed[0] is messages[0]
+    assert trimmed[1].content.startswith("[elided 12B tool result sha256=")
+    assert trimmed[2:] == messages[2:]
+    assert messages[1].content == "old contents"
+
+
+def test_trim_keeps_sent_prefix_stable_within_a_block():
+    middleware = TrimToolResultsMiddleware(max_recent_messages=2, block_size=4)
+    history = []
+    for i in range(5):
+        history += [
+            AIMessage(f"call {i}"),
+            ToolMessage(f"result {i}", tool_call_id=str(i)),
+        ]
+
+    # Cutoffs: 6 messages -> 4, 8 -> 4, 10 -> 8
+    six, eight, ten = (middleware._trim(history[:n]) for n in (6, 8, 10))
+
+    assert [m.content for m in eight[:6]] == [m.content for m in six]
+    assert eight[5].content == "result 2"
+    assert ten[5].content.startswith("[elided")
+    assert [m.content for m in ten[:4]] == [m.content for m in eight[:4]]
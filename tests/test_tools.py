@@ -1,10 +1,13 @@
+import asyncio
 import json
+import os
 import sys
 from pathlib import Path
 
 sys.path.append(str(Path(__file__).resolve().parents[1]))
 
-from tools import list_files, read_file
+import tools
+from tools import bash, edit_file, list_files, prefetch_paths, read_file
 
 
 def test_read_file_returns_file_contents(tmp_path):
@@ -17,6 +20,110 @@ def test_read_file_returns_file_contents(tmp_path):
     assert result == content
 
 
+def test_list_files_marks_symlinked_directories_without_descending(tmp_path):
+    (tmp_path / "real").mkdir()
+    (tmp_path / "real" / "a.txt").write_text("")
+    (tmp_path / "link").symlink_to(tmp_path / "real")
+
+    files = json.loads(list_files.invoke({"path": str(tmp_path)}))
+
+    assert files == ["link/", "real/", "real/a.txt"]
+
+
+def test_list_files_skips_unreadable_subdirectories(tmp_path, monkeypatch):
+    (tmp_path / "locked").mkdir()
+    (tmp_path / "locked" / "hidden.txt").write_text("")
+    (tmp_path / "open.txt").write_text("")
+    locked = str(tmp_path / "locked")
+    real_scandir = os.scandir
+
+    def scandir(path):
+        if path == locked:
+            raise PermissionError(13, "Permission denied", path)
+        return real_scandir(path)
+
+    monkeypatch.setattr(tools.os, "scandir", scandir)
+
+    assert json.loads(list_files.invoke({"path": str(tmp_path)})) == [
+        "locked/",
+        "open.txt",
+    ]
+    assert list_files.invoke({"path": locked}).startswith("Error: Failed to list")
+
+
+def test_list_files_handles_non_utf8_file_names(tmp_path):
+    (tmp_path / "café.txt").write_text("")
+    os.close(os.open(os.path.join(os.fsencode(tmp_path), b"caf\xe9.bin"), os.O_CREAT))
+
+    result = list_files.invoke({"path": str(tmp_path)})
+
+    assert json.loads(result) == ["café.txt", "caf\udce9.bin"]
+
+
+def test_dumps_uses_the_same_format_without_orjson(monkeypatch):
+    names = ["café.txt", "src/"]
+    with_orjson = tools._dumps(names)
+    monkeypatch.setattr(tools, "orjson", None)
+
+    assert tools._dumps(names) == with_orjson
+
+
+def test_read_file_returns_requested_line_range(tmp_path):
+    file_path = tmp_path / "example.txt"
+    file_path.write_text("one\ntwo\nthree\nfour\n")
+
+    result = read_file.invoke({"path": str(file_path), "line_range": (2, 3)})
+
+    assert result == "two\nthree\n"
+
+
+def test_read_file_rejects_files_over_size_limit(tmp_path, monkeypatch):
+    file_path = tmp_path / "big.log"
+    file_path.write_text("x" * 100)
+    monkeypatch.setattr(tools, "MAX_READ_BYTES", 10)
+
+    result = read_file.invoke({"path": str(file_path)})
+
+    assert result.startswith("Error: File")
+    assert "too large" in result
+
+
+def test_read_file_mmap_path_reads_whole_file_and_line_range(tmp_path, monkeypatch):
+    file_path = tmp_path / "large.txt"
+    file_path.write_text("".join(f"line {i}\n" for i in range(100)))
+    monkeypatch.setattr(tools, "MMAP_THRESHOLD", 16)
+
+    whole = read_file.invoke({"path": str(file_path)})
+    sliced = read_file.invoke({"path": str(file_path), "line_range": (3, 4)})
+
+    assert whole == file_path.read_text()
+    assert sliced == "line 2\nline 3\n"
+
+
+def test_read_file_reports_truncated_line_range(tmp_path, monkeypatch):
+    file_path = tmp_path / "example.txt"
+    file_path.write_text("0123456789\nabc\n")
+    monkeypatch.setattr(tools, "MAX_READ_BYTES", 4)
+
+    result = read_file.invoke({"path": str(file_path), "line_range": (1, 2)})
+
+    assert result.startswith("0123\n[line range truncated at 4 bytes")
+
+
+def test_edit_file_matches_crlf_text_shown_by_read_file(tmp_path):
+    file_path = tmp_path / "windows.py"
+    file_path.write_bytes(b"a = 1\r\nb = 2\r\n")
+    shown = read_file.invoke({"path": str(file_path)})
+
+    result = edit_file.invoke(
+        {"path": str(file_path), "old_str": shown[:7], "new_str": "a = 3\r\n"}
+    )
+
+    assert shown == "a = 1\r\nb = 2\r\n"
+    assert result == "OK"
+    assert file_path.read_bytes() == b"a = 3\r\nb = 2\r\n"
+
+
 def test_list_files_ignores_hidden_directories(tmp_path, monkeypatch):
     root_dir = tmp_path / "project"
     hidden_dir = root_dir / ".hidden"
@@ -35,3 +142,167 @@ def test_list_files_ignores_hidden_directories(tmp_path, monkeypatch):
     assert "visible/" in files
     assert "visible/public.txt" in files
     assert not any(path.startswith(".hidden") for path in files)
+
+
+def test_list_files_skips_hidden_entries_in_subdirectories(tmp_path):
+    nested_dir = tmp_path / "src" / "pkg"
+    nested_dir.mkdir(parents=True)
+    (nested_dir / "module.py").write_text("")
+    (nested_dir / ".env").write_text("SECRET=1")
+    (tmp_path / "src" / ".cache").mkdir()
+    (tmp_path / "src" / ".cache" / "blob").write_text("")
+
+    result = list_files.invoke({"path": str(tmp_path)})
+    files = json.loads(result)
+
+    assert files == ["src/", "src/pkg/", "src/pkg/module.py"]
+
+
+def test_prefetched_contents_are_invalidated_by_edit_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "notes.txt").write_text("before")
+
+    assert prefetch_paths("What's in notes.txt and missing.txt?") == ["notes.txt"]
+    edit_file.invoke({"path": "notes.txt", "old_str": "before", "new_str": "after"})
+
+    assert read_file.invoke({"path": "notes.txt"}) == "after"
+
+
+def test_prefetch_cache_matches_differently_spelled_paths(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "notes.txt").write_text("before")
+
+    prefetch_paths("What's in notes.txt?")
+    edit_file.invoke({"path": "./notes.txt", "old_str": "before", "new_str": "after"})
+    assert read_file.invoke({"path": "notes.txt"}) == "after"
+
+    prefetch_paths("What's in ./notes.txt?")
+    assert read_file.invoke({"path": "notes.txt"}) == "after"
+    assert tools._prefetched == {}
+
+
+def test_prefetched_contents_are_dropped_when_file_changes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    notes = tmp_path / "notes.txt"
+    notes.write_text("before")
+
+    prefetch_paths("What's in notes.txt?")
+    tools._prefetched["notes.txt"][0].result()
+    notes.write_text("changed outside the agent")
+    os.utime(notes, ns=(0, 0))
+
+    assert read_file.invoke({"path": "notes.txt"}) == "changed outside the agent"
+
+
+def test_clear_prefetched_drops_unused_entries(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "notes.txt").write_text("before")
+
+    assert prefetch_paths("What's in notes.txt?") == ["notes.txt"]
+    tools.clear_prefetched()
+
+    assert tools._prefetched == {}
+
+
+def test_edit_file_rejects_ambiguous_old_str(tmp_path):
+    file_path = tmp_path / "example.py"
+    file_path.write_text("x = 1\nx = 1\n")
+    file_path.chmod(0o755)
+
+    ambiguous = edit_file.invoke(
+        {"path": str(file_path), "old_str": "x = 1", "new_str": "x = 2"}
+    )
+    file_path.write_text("x = 1\ny = 1\n")
+    unique = edit_file.invoke(
+        {"path": str(file_path), "old_str": "x = 1", "new_str": "x = 2"}
+    )
+
+    assert ambiguous.startswith("Error: old_str found more than once")
+    assert unique == "OK"
+    assert file_path.read_text() == "x = 2\ny = 1\n"
+    assert file_path.stat().st_mode & 0o777 == 0o755
+    assert [p.name for p in tmp_path.iterdir()] == ["example.py"]
+
+
+def test_edit_file_creates_new_files_with_umask_permissions(tmp_path):
+    file_path = tmp_path / "new.txt"
+    umask = os.umask(0)
+    os.umask(umask)
+
+    edit_file.invoke({"path": str(file_path), "old_str": "", "new_str": "hi"})
+
+    assert file_path.stat().st_mode & 0o777 == 0o666 & ~umask
+
+
+def test_edit_file_through_symlink_edits_target_and_keeps_link(tmp_path):
+    target = tmp_path / "target.txt"
+    target.write_text("a = 1\n")
+    link = tmp_path / "link.txt"
+    link.symlink_to(target)
+
+    result = edit_file.invoke({"path": str(link), "old_str": "1", "new_str": "2"})
+
+    assert result == "OK"
+    assert link.is_symlink()
+    assert target.read_text() == "a = 2\n"
+
+
+def test_edit_file_creates_missing_parent_directories(tmp_path):
+    file_path = tmp_path / "new" / "pkg" / "module.py"
+
+    result = edit_file.invoke(
+        {"path": str(file_path), "old_str": "", "new_str": "x = 1\n"}
+    )
+
+    assert result.startswith("Successfully created")
+    assert file_path.read_text() == "x = 1\n"
+
+
+def test_edit_file_creates_parent_directories_after_chdir(tmp_path, monkeypatch):
+    for name in ("c1", "c2"):
+        (tmp_path / name).mkdir()
+    monkeypatch.chdir(tmp_path / "c1")
+    edit_file.invoke({"path": "sub/x.txt", "old_str": "", "new_str": "x"})
+    monkeypatch.chdir(tmp_path / "c2")
+
+    result = edit_file.invoke({"path": "sub/y.txt", "old_str": "", "new_str": "y"})
+
+    assert result.startswith("Successfully created")
+    assert (tmp_path / "c2" / "sub" / "y.txt").read_text() == "y"
+
+
+def test_bash_reports_exit_code_and_combined_output():
+    result = bash.invoke({"command": "echo out; echo err >&2; exit 3"})
+
+    assert result == "Command failed with exit code 3:\nout\nerr"
+
+
+def test_bash_runs_natively_under_ainvoke():
+    result = asyncio.run(bash.ainvoke({"command": "echo hi"}))
+
+    assert result == "hi"
+    assert bash.name == "bash"
+    assert not hasattr(tools, "abash")
+
+
+def test_bash_invoke_works_inside_a_running_event_loop():
+    async def call_sync_tool():
+        return bash.invoke({"command": "echo hi"})
+
+    assert asyncio.run(call_sync_tool()) == "hi"
+
+
+def test_bash_kills_commands_that_exceed_timeout(monkeypatch):
+    monkeypatch.setattr(tools, "BASH_TIMEOUT_SECONDS", 0.2)
+
+    result = bash.invoke({"command": "echo started; sleep 5"})
+
+    assert result == "Error: Command timed out after 0.2s:\nstarted"
+
+
+def test_bash_truncates_and_stops_runaway_output(monkeypatch):
+    monkeypatch.setattr(tools, "MAX_BASH_OUTPUT_BYTES", 1024)
+
+    result = bash.invoke({"command": "yes"})
+
+    assert result.endswith("[output truncated at 1024 bytes]")
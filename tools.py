@@ -1,36 +1,199 @@
 """Tool definitions for the codegen demo agent."""
 
+import asyncio
 import json
 import logging
-import subprocess
+import mmap
+import os
+import re
+import signal
+import stat
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 
 from langchain.tools import tool
+from langchain_core.tools import StructuredTool
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+# Files larger than this are refused unless a line range is requested
+MAX_READ_BYTES = 1024 * 1024
+# Files at least this large are read through mmap instead of being slurped
+MMAP_THRESHOLD = 256 * 1024
+
+
+def _dumps(obj) -> str:
+    """Serializes a tool result to compact JSON, using orjson when it is available."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode()
+        except orjson.JSONEncodeError:
+            pass
+    text = json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+    try:
+        text.encode()
+    except UnicodeEncodeError:
+        # Surrogate-escaped names of non-UTF-8 files can only be written as
+        # \u escapes, which still decode back to the same path.
+        text = json.dumps(obj, separators=(",", ":"))
+    return text
 
 
 class ReadFileInput(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
     path: str = Field(description="The relative path of a file in the working directory.")
+    line_range: tuple[int, int] | None = Field(
+        default=None,
+        description="Optional 1-based, inclusive (start, end) line range to read "
+        "instead of the whole file.",
+    )
 
 
-@tool(args_schema=ReadFileInput)
-def read_file(path: str) -> str:
-    """Read the contents of a given relative file path."""
-    logging.info(f"Reading file: {path}")
+def _slice_lines(buf, line_range: tuple[int, int]) -> tuple[bytes, bool]:
+    """Returns the bytes of the given 1-based, inclusive line range of `buf`.
+
+    The slice is capped at `MAX_READ_BYTES`; the flag says whether it was cut.
+    """
+    start, end = line_range
+    begin = 0
+    for _ in range(start - 1):
+        newline = buf.find(b"\n", begin)
+        if newline < 0:
+            return b"", False
+        begin = newline + 1
+    stop = begin
+    for _ in range(end - start + 1):
+        newline = buf.find(b"\n", stop)
+        if newline < 0:
+            stop = len(buf)
+            break
+        stop = newline + 1
+    cap = begin + MAX_READ_BYTES
+    return buf[begin : min(stop, cap)], stop > cap
+
+
+def _decode_text(data: bytes, errors: str = "replace") -> str:
+    """Decodes file bytes the way every tool sees text: UTF-8, newlines untouched."""
+    return data.decode("utf-8", errors=errors)
+
+
+def _read_file(path: str, line_range: tuple[int, int] | None = None) -> str:
+    """Reads a file (or a line range of it), returning an error string on failure."""
+    logger.info("Reading file: %s", path)
     try:
-        content = Path(path).read_text()
-        logging.info(f"Successfully read file {path} ({len(content)} bytes)")
+        if line_range is not None and not 1 <= line_range[0] <= line_range[1]:
+            return f"Error: Invalid line range {line_range} for '{path}'"
+
+        file_path = Path(path)
+        size = file_path.stat().st_size
+        if line_range is None and size > MAX_READ_BYTES:
+            logger.error("File too large to read: %s (%s bytes)", path, size)
+            return (
+                f"Error: File '{path}' is too large ({size} bytes). "
+                "Request a line_range instead."
+            )
+
+        truncated = False
+        if size < MMAP_THRESHOLD:
+            data = file_path.read_bytes()
+            if line_range is not None:
+                data, truncated = _slice_lines(data, line_range)
+        else:
+            with open(file_path, "rb") as f, mmap.mmap(
+                f.fileno(), 0, access=mmap.ACCESS_READ
+            ) as mm:
+                if line_range is not None:
+                    data, truncated = _slice_lines(mm, line_range)
+                else:
+                    data = mm[:]
+
+        content = _decode_text(data)
+        logger.info("Successfully read file %s (%s bytes)", path, len(content))
+        if truncated:
+            return (
+                f"{content}\n[line range truncated at {MAX_READ_BYTES} bytes; "
+                "request a smaller range to see the rest]"
+            )
         return content
     except FileNotFoundError:
-        logging.error(f"File not found: {path}")
+        logger.error("File not found: %s", path)
         return f"Error: File not found at '{path}'"
     except Exception as e:
-        logging.error(f"Failed to read file {path}: {e}")
+        logger.error("Failed to read file %s: %s", path, e)
         return f"Error: Failed to read file '{path}': {e}"
 
 
+# Matches file-like tokens in a prompt that are worth reading ahead of time
+PREFETCH_PATTERN = re.compile(r"\b[\w./-]+\.(?:py|md|toml|yaml|json|txt)\b")
+
+_prefetch_executor = ThreadPoolExecutor(max_workers=4)
+# Pending reads keyed by os.path.normpath, so "./a.py" and "a.py" share an
+# entry, together with the file's (st_mtime_ns, st_size) when the read started
+_prefetched: dict[str, tuple[Future[str], tuple[int, int]]] = {}
+
+
+def _file_signature(path: str) -> tuple[int, int] | None:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def prefetch_paths(prompt: str) -> list[str]:
+    """Starts reading files mentioned in `prompt` in the background.
+
+    `read_file` picks up the result instead of hitting the disk again, which
+    hides the read inside the time the model spends deciding to call it.
+    """
+    paths = []
+    for path in dict.fromkeys(PREFETCH_PATTERN.findall(prompt)):
+        key = os.path.normpath(path)
+        if key in _prefetched or not Path(path).is_file():
+            continue
+        signature = _file_signature(path)
+        if signature is None:
+            continue
+        logger.info("Prefetching file: %s", path)
+        _prefetched[key] = (_prefetch_executor.submit(_read_file, path), signature)
+        paths.append(path)
+    return paths
+
+
+def clear_prefetched() -> None:
+    """Drops prefetched reads that were never used, e.g. when a run ends."""
+    for future, _signature in _prefetched.values():
+        future.cancel()
+    _prefetched.clear()
+
+
+@tool(args_schema=ReadFileInput)
+def read_file(path: str, line_range: tuple[int, int] | None = None) -> str:
+    """Read the contents of a given relative file path."""
+    entry = _prefetched.pop(os.path.normpath(path), None)
+    if entry is not None and line_range is None:
+        future, signature = entry
+        # The file may have changed since (e.g. via bash or another process)
+        if _file_signature(path) == signature:
+            logger.info("Using prefetched contents of %s", path)
+            return future.result()
+        future.cancel()
+    return _read_file(path, line_range)
+
+
 class ListFilesInput(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
     path: str = Field(
         default=".",
         description="Optional relative path to list files from. Defaults to current directory.",
@@ -40,99 +203,241 @@ class ListFilesInput(BaseModel):
 @tool(args_schema=ListFilesInput)
 def list_files(path: str = ".") -> str:
     """List files and directories at a given path."""
-    logging.info(f"Listing files in directory: {path}")
+    logger.info("Listing files in directory: %s", path)
     try:
-        base_path = Path(path)
+        # Work on plain strings: entry paths all start with the base directory,
+        # so the relative path is a slice and no Path objects are built per entry.
+        base_dir = os.fspath(Path(path))
+        prefix_len = len(os.path.join(base_dir, ""))
         files = []
-        for p in sorted(base_path.rglob("*")):
-            # Skip hidden directories like .devenv or .git
-            if any(part.startswith(".") for part in p.parts):
+        stack = [base_dir]
+        while stack:
+            current = stack.pop()
+            try:
+                entries = os.scandir(current)
+            except OSError as e:
+                # Only an unreadable base path fails the listing; unreadable
+                # subdirectories are skipped, like rglob does.
+                if current is base_dir:
+                    raise
+                logger.warning("Skipping unreadable directory %s: %s", current, e)
                 continue
-            rel_path = p.relative_to(base_path)
-            files.append(str(rel_path) + ("/" if p.is_dir() else ""))
-        logging.info(f"Successfully listed {len(files)} files in {path}")
-        return json.dumps(files)
+            with entries:
+                for entry in entries:
+                    # Skip hidden entries like .devenv or .git without descending
+                    if entry.name[:1] == ".":
+                        continue
+                    rel_path = entry.path[prefix_len:]
+                    if entry.is_dir():
+                        rel_path += "/"
+                        # Symlinked directories are listed but not descended into
+                        if not entry.is_symlink():
+                            stack.append(entry.path)
+                    files.append(rel_path)
+        files.sort()
+        logger.info("Successfully listed %s files in %s", len(files), path)
+        return _dumps(files)
     except Exception as e:
-        logging.error(f"Failed to list files in {path}: {e}")
+        logger.error("Failed to list files in %s: %s", path, e)
         return f"Error: Failed to list files in '{path}': {e}"
 
 
 class BashInput(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
     command: str = Field(description="The bash command to execute.")
 
 
-@tool(args_schema=BashInput)
-def bash(command: str) -> str:
-    """Execute a bash command and return its output."""
-    logging.info(f"Executing bash command: {command}")
+# Wall-clock limit for a single bash command
+BASH_TIMEOUT_SECONDS = 120
+# Output beyond this many bytes is dropped and the command is killed
+MAX_BASH_OUTPUT_BYTES = 64 * 1024
+# How long to wait for a killed command's output pipe to close
+KILL_GRACE_SECONDS = 5
+
+
+def _kill_process_group(proc: asyncio.subprocess.Process) -> None:
+    """Kills the shell and anything it spawned."""
     try:
-        result = subprocess.run(
-            command,
-            shell=True,
-            check=True,
-            capture_output=True,
-            text=True,
-            executable="/bin/bash",
-        )
-        output = result.stdout.strip()
-        logging.info(
-            f"Bash command executed successfully, output length: {len(output)} chars"
-        )
-        return output
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Bash command failed: {e}")
-        return f"Command failed with exit code {e.returncode}:\n{e.stderr}"
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+async def _run_bash(command: str) -> str:
+    """Runs `command`, streaming its combined output up to the size cap."""
+    logger.info("Executing bash command: %s", command)
+    proc = await asyncio.create_subprocess_shell(
+        command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        executable="/bin/bash",
+        start_new_session=True,
+    )
+    output = bytearray()
+    truncated = False
+
+    async def collect() -> None:
+        nonlocal truncated
+        # Keep draining after a kill so the pipe reaches EOF and wait() returns
+        while chunk := await proc.stdout.read(65536):
+            if truncated:
+                continue
+            output.extend(chunk)
+            if len(output) > MAX_BASH_OUTPUT_BYTES:
+                truncated = True
+                _kill_process_group(proc)
+        await proc.wait()
+
+    try:
+        await asyncio.wait_for(collect(), timeout=BASH_TIMEOUT_SECONDS)
+    except TimeoutError:
+        _kill_process_group(proc)
+        try:
+            # A detached grandchild can keep the pipe open, so bound the drain too
+            await asyncio.wait_for(proc.communicate(), timeout=KILL_GRACE_SECONDS)
+        except TimeoutError:
+            pass
+        text = output.decode(errors="replace").strip()
+        logger.error("Bash command timed out after %ss", BASH_TIMEOUT_SECONDS)
+        return f"Error: Command timed out after {BASH_TIMEOUT_SECONDS}s:\n{text}"
+
+    text = output[:MAX_BASH_OUTPUT_BYTES].decode(errors="replace").strip()
+    if truncated:
+        logger.warning("Bash output exceeded %s bytes", MAX_BASH_OUTPUT_BYTES)
+        return f"{text}\n[output truncated at {MAX_BASH_OUTPUT_BYTES} bytes]"
+    if proc.returncode != 0:
+        logger.error("Bash command failed with exit code %s", proc.returncode)
+        return f"Command failed with exit code {proc.returncode}:\n{text}"
+    logger.info(
+        "Bash command executed successfully, output length: %s chars", len(text)
+    )
+    return text
+
+
+def _bash(command: str) -> str:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(_run_bash(command))
+    # Called synchronously from code that is already inside an event loop (e.g.
+    # a notebook), so run the coroutine on a private loop in a worker thread.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, _run_bash(command)).result()
+
+
+# A single tool with both implementations: invoke() runs the coroutine on a
+# private event loop, ainvoke() awaits it on the caller's loop.
+bash = StructuredTool.from_function(
+    func=_bash,
+    coroutine=_run_bash,
+    name="bash",
+    description="Execute a bash command and return its output.",
+    args_schema=BashInput,
+)
 
 
 class EditFileInput(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
     path: str = Field(description="The path to the file.")
     old_str: str = Field(description="The exact text to search for and replace.")
     new_str: str = Field(description="The text to replace old_str with.")
 
 
+def _ensure_parent_dir(file_path: Path) -> None:
+    """Creates the parent directory of `file_path` if it does not exist yet."""
+    parent = file_path.parent
+    if not parent.is_dir():
+        parent.mkdir(parents=True, exist_ok=True)
+
+
+def _atomic_write(file_path: Path, content: str) -> None:
+    """Replaces an existing file's contents via a temp file swapped into place.
+
+    Symlinks are resolved first so the link target is edited and the link kept,
+    and the original file mode is carried over to the new file.
+    """
+    target = file_path.resolve()
+    fd, tmp_path = tempfile.mkstemp(dir=target.parent, prefix=f".{target.name}.")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+            f.write(content)
+        os.chmod(tmp_path, stat.S_IMODE(target.stat().st_mode))
+        os.replace(tmp_path, target)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
 @tool(args_schema=EditFileInput)
 def edit_file(path: str, old_str: str, new_str: str) -> str:
     """Make edits to a text file by replacing content."""
     if not path or old_str == new_str:
-        logging.error("EditFile failed: invalid input parameters")
+        logger.error("EditFile failed: invalid input parameters")
         return (
             "Error: Invalid input parameters. Path cannot be empty and old_str must differ"
             " from new_str."
         )
 
+    # Any prefetched contents are stale once the file is edited
+    entry = _prefetched.pop(os.path.normpath(path), None)
+    if entry is not None:
+        entry[0].cancel()
+
     file_path = Path(path)
-    logging.info(
-        f"Editing file: {path} (replacing {len(old_str)} chars with {len(new_str)} chars)"
+    logger.info(
+        "Editing file: %s (replacing %s chars with %s chars)",
+        path,
+        len(old_str),
+        len(new_str),
     )
 
     try:
-        file_path.parent.mkdir(parents=True, exist_ok=True)
+        _ensure_parent_dir(file_path)
 
         if not file_path.exists() and old_str == "":
-            logging.info(f"File does not exist, creating new file: {path}")
-            file_path.write_text(new_str)
+            logger.info("File does not exist, creating new file: %s", path)
+            file_path.write_text(new_str, encoding="utf-8", newline="")
             return f"Successfully created and wrote to new file {path}"
 
-        old_content = file_path.read_text()
+        # Read exactly as read_file does, so old_str copied from its output
+        # matches; undecodable bytes are refused rather than replaced on write.
+        try:
+            old_content = _decode_text(file_path.read_bytes(), errors="strict")
+        except UnicodeDecodeError:
+            return f"Error: File '{path}' is not valid UTF-8 text."
 
         if old_str == "":
             new_content = old_content + new_str
         else:
-            count = old_content.count(old_str)
-            if count == 0:
+            # Probe with a short head of old_str first; a miss fails fast and a
+            # hit gives the full search a starting offset instead of restarting.
+            head_index = old_content.find(old_str[:64])
+            if head_index < 0:
                 return "Error: old_str not found in file."
-            if count > 1:
-                return (
-                    f"Error: old_str found {count} times, must be unique for safety."
-                )
-            new_content = old_content.replace(old_str, new_str, 1)
-
-        file_path.write_text(new_content)
-        logging.info(f"Successfully edited file {path}")
+            index = old_content.find(old_str, head_index)
+            if index < 0:
+                return "Error: old_str not found in file."
+            if old_content.find(old_str, index + len(old_str)) >= 0:
+                return "Error: old_str found more than once, must be unique for safety."
+            new_content = (
+                old_content[:index] + new_str + old_content[index + len(old_str) :]
+            )
+
+        _atomic_write(file_path, new_content)
+        logger.info("Successfully edited file %s", path)
         return "OK"
     except Exception as e:
-        logging.error(f"Failed to edit file {path}: {e}")
+        logger.error("Failed to edit file %s: %s", path, e)
         return f"Error: An unexpected error occurred: {e}"
 
 
-__all__ = ["bash", "edit_file", "list_files", "read_file"]
+__all__ = [
+    "bash",
+    "clear_prefetched",
+    "edit_file",
+    "list_files",
+    "prefetch_paths",
+    "read_file",
+]